@@ -15,14 +15,19 @@ Usage:
 """
 
 import argparse
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+import functools
 import os
+from pathlib import Path
 import sys
 import subprocess
+import tempfile
 
-from mutagen.easyid3 import EasyID3
+import mutagen
+from mutagen import MutagenError
 from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, APIC
+from mutagen.id3 import ID3
 
 try:
     from olclient.openlibrary import OpenLibrary
@@ -31,12 +36,40 @@ except ImportError:
     OpenLibrary = None
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import requests_cache
+except ImportError:
+    requests_cache = None
+
+# Buffer size for bulk file copies
+COPY_BUFFER_SIZE = 1 << 20
+# Sampling frequencies by ADTS sampling_frequency_index
+ADTS_SAMPLE_RATES = (96000, 88200, 64000, 48000, 44100, 32000, 24000, 22050, 16000, 12000, 11025, 8000, 7350)
+# Chunk size for streamed HTTP downloads
+DOWNLOAD_CHUNK_SIZE = 1 << 16
+# Metadata/cover responses are cached here between runs (if requests-cache is installed)
+HTTP_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cache", "m4binder", "http.sqlite")
+HTTP_CACHE_EXPIRE_AFTER = 30 * 24 * 60 * 60  # seconds
+# (connect, read) timeout in seconds for every HTTP request
+HTTP_TIMEOUT = (3.05, 30)
 
 def get_duration(file_path):
     """
-    Uses ffprobe to get the duration (in seconds) of the file.
+    Gets the duration (in seconds) of any audio file mutagen understands
+    (MP3, MP4/M4A, ...), falling back to ffprobe for anything else.
     Returns a float. 
     """
+    try:
+        audio = mutagen.File(file_path)
+    except MutagenError:
+        audio = None
+    if audio is not None and audio.info.length:
+        return audio.info.length
+
+    # Not something mutagen can read, ask ffprobe
     result = subprocess.run(
         [
             "ffprobe", 
@@ -56,122 +89,218 @@ def get_duration(file_path):
         print(f"Warning: Could not determine duration of {file_path}.")
         return 0.0
 
-def extract_id3_tags(file_path):
-    """Return basic ID3 title/artist from an MP3 file."""
+# Everything the converter needs from one MP3, read in a single parse
+MP3Probe = namedtuple("MP3Probe", ["path", "duration", "sample_rate", "title", "album", "artist", "apic", "is_mp3"])
+
+def _first_text(tags, frame_id):
+    """Returns the first text value of an ID3 frame, or None."""
+    frame = tags.get(frame_id) if tags else None
+    if frame and frame.text:
+        return str(frame.text[0])
+    return None
+
+def probe_mp3(mp3_path, with_cover=True):
+    """
+    Loads an MP3 once and returns an MP3Probe with its duration, sample rate, title,
+    album, artist, first APIC (cover art) frame and whether the audio really
+    is MPEG layer III (is_mp3).
+    With with_cover=False the APIC frame is dropped (apic is None), so the
+    image data isn't kept in memory for files whose cover is never used.
+    If the file isn't a parseable MP3, only the duration is filled in (see
+    get_duration).
+    """
     try:
-        tags = EasyID3(file_path)
-        return {
-            "album": tags.get("album", [None])[0],
-            "artist": tags.get("artist", [None])[0]
-        }
-    except Exception:
-        return {}
+        audio = MP3(mp3_path, ID3=ID3)
+    except MutagenError:
+        return MP3Probe(mp3_path, get_duration(mp3_path), None, None, None, None, None, False)
+
+    tags = audio.tags
+    apic_frames = tags.getall("APIC") if tags and with_cover else []
+    return MP3Probe(
+        path=mp3_path,
+        duration=audio.info.length,
+        sample_rate=audio.info.sample_rate,
+        title=_first_text(tags, "TIT2"),
+        album=_first_text(tags, "TALB"),
+        artist=_first_text(tags, "TPE1"),
+        apic=apic_frames[0] if apic_frames else None,
+        is_mp3=audio.info.layer == 3
+    )
+
+def probe_mp3s(mp3_files, max_workers=None):
+    """
+    Probes every MP3 concurrently. Returns MP3Probes in input order.
+    Only the first file keeps its cover art (that's the one the book uses).
+    """
+    if not mp3_files:
+        return []
+    with_cover = [True] + [False] * (len(mp3_files) - 1)
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        return list(executor.map(probe_mp3, mp3_files, with_cover))
 
-def extract_embedded_cover_art(mp3_path):
+def extract_embedded_cover_art(probe):
     """
-    Checks if an MP3 file has embedded cover art (APIC frame).
+    Checks if a probed MP3 has embedded cover art (APIC frame).
     If found, saves it to a file (next to the MP3) and returns the file path.
     Otherwise returns None.
     """
-    # Load MP3 with ID3 tags
-    audio = MP3(mp3_path, ID3=ID3)
-    if not audio.tags:
+    apic_frame = probe.apic
+    if apic_frame is None:
         return None
 
-    # Look for APIC (attached picture) frames
-    for tag_key in audio.tags.keys():
-        if tag_key.startswith("APIC"):
-            apic_frame = audio.tags[tag_key]
-            if isinstance(apic_frame, APIC):
-                # Determine a file extension based on MIME type (jpg, png, etc.)
-                mime_lower = apic_frame.mime.lower()
-                if "jpeg" in mime_lower or "jpg" in mime_lower:
-                    extension = ".jpg"
-                elif "png" in mime_lower:
-                    extension = ".png"
-                elif "gif" in mime_lower:
-                    extension = ".gif"
-                else:
-                    extension = ".cover"  # fallback if unknown
-
-                # Build a file path in the same folder as the MP3
-                base_name = os.path.splitext(os.path.basename(mp3_path))[0]
-                cover_filename = f"{base_name}_cover{extension}"
-                cover_path = os.path.join(os.path.dirname(mp3_path), cover_filename)
-
-                # Write out the image data
-                with open(cover_path, "wb") as f:
-                    f.write(apic_frame.data)
-
-                return cover_path
-
-    # No APIC frame found
-    return None
+    # Determine a file extension based on MIME type (jpg, png, etc.)
+    mime_lower = apic_frame.mime.lower()
+    if "jpeg" in mime_lower or "jpg" in mime_lower:
+        extension = ".jpg"
+    elif "png" in mime_lower:
+        extension = ".png"
+    elif "gif" in mime_lower:
+        extension = ".gif"
+    else:
+        extension = ".cover"  # fallback if unknown
 
-def create_ffmetadata(files, metadata_file, book_metadata=None):
-    """
-    Creates an ffmetadata file with metadata (title, artist, etc.)
-    plus chapter markers for each file. 
-    """
-    lines = []
-    lines.append(";FFMETADATA1")
-
-    # If we have book metadata, inject it here.
-    if book_metadata:
-        if "title" in book_metadata:
-            lines.append(f"title={book_metadata['title']}")
-            lines.append(f"album={book_metadata['title']}")
-        if "authors" in book_metadata and len(book_metadata['authors']) > 0 and book_metadata['authors'][0] is not None:
-            lines.append(f"artist={', '.join(book_metadata['authors'])}")
-            lines.append(f"album_artist={', '.join(book_metadata['authors'])}")
-        if "publisher" in book_metadata:
-            lines.append(f"publisher={book_metadata['publisher']}")
-
-    current_start_ms = 0
-    for idx, file_path in enumerate(files, start=1):
-        # Get the track duration
-        duration_sec = get_duration(file_path)
-        duration_ms = int(round(duration_sec * 1000))
-        chapter_start = current_start_ms
-        chapter_end = chapter_start + duration_ms
-
-        # Attempt to read a 'title' tag from the MP3
-        try:
-            tags = EasyID3(file_path)
-            mp3_title = tags.get("title", [None])[0]
-        except Exception:
-            mp3_title = None
+    # Build a file path in the same folder as the MP3
+    mp3_path = Path(probe.path)
+    cover_path = str(mp3_path.with_name(f"{mp3_path.stem}_cover{extension}"))
 
-        # Fallback to "Chapter X" if no ID3 title is found
-        if not mp3_title:
-            mp3_title = f"Chapter {idx}"
+    # Write out the image data
+    with open(cover_path, "wb") as f:
+        f.write(apic_frame.data)
 
-        lines.append("[CHAPTER]")
-        lines.append("TIMEBASE=1/1000")
-        lines.append(f"START={chapter_start}")
-        lines.append(f"END={chapter_end}")
-        lines.append(f"title={mp3_title}")
+    return cover_path
 
-        current_start_ms += duration_ms
+def create_ffmetadata(probes, metadata_file, book_metadata=None, durations=None):
+    """
+    Creates an ffmetadata file with metadata (title, artist, etc.)
+    plus chapter markers for each probed MP3 (see probe_mp3). 
+    `durations` optionally overrides the probed chapter lengths (seconds,
+    one per probe).
+    """
+    if durations is None:
+        durations = [probe.duration for probe in probes]
 
+    # Written straight to the (buffered) file, one write per chapter
     with open(metadata_file, 'w', encoding='utf-8') as f:
-        f.write("\n".join(lines))
-        f.write("\n")
+        f.write(";FFMETADATA1\n")
+
+        # If we have book metadata, inject it here.
+        if book_metadata:
+            if "title" in book_metadata:
+                f.write(f"title={book_metadata['title']}\n")
+                f.write(f"album={book_metadata['title']}\n")
+            if "authors" in book_metadata and len(book_metadata['authors']) > 0 and book_metadata['authors'][0] is not None:
+                f.write(f"artist={', '.join(book_metadata['authors'])}\n")
+                f.write(f"album_artist={', '.join(book_metadata['authors'])}\n")
+            if "publisher" in book_metadata:
+                f.write(f"publisher={book_metadata['publisher']}\n")
+
+        current_start_ms = 0
+        for idx, (probe, duration_sec) in enumerate(zip(probes, durations), start=1):
+            # Get the track duration
+            duration_ms = int(round(duration_sec * 1000))
+            chapter_start = current_start_ms
+            chapter_end = chapter_start + duration_ms
+
+            # Fallback to "Chapter X" if no ID3 title is found
+            mp3_title = probe.title or f"Chapter {idx}"
+
+            f.write(
+                "[CHAPTER]\n"
+                "TIMEBASE=1/1000\n"
+                f"START={chapter_start}\n"
+                f"END={chapter_end}\n"
+                f"title={mp3_title}\n"
+            )
+
+            current_start_ms += duration_ms
+
+def find_mp3_files(folder):
+    """Returns the sorted list of .mp3 paths in folder."""
+    # scandir gets the file type along with the name, so there's no
+    # extra stat per entry
+    with os.scandir(folder) as entries:
+        mp3_files = [
+            entry.path
+            for entry in entries
+            if entry.name[-4:].lower() == ".mp3" and entry.is_file()
+        ]
+    mp3_files.sort()
+    return mp3_files
+
+def find_subfolders(folder):
+    """Returns the paths of the directories directly inside folder."""
+    with os.scandir(folder) as entries:
+        return [entry.path for entry in entries if entry.is_dir()]
 
 def create_concat_list(file_paths, list_file):
     """Creates a concat list for FFmpeg."""
     with open(list_file, 'w', encoding='utf-8') as f:
         for path in file_paths:
+            # Relative entries would be resolved against the list's folder
+            path = os.path.abspath(path)
             # For windows, escape backslashes in paths
             safe_path = path.replace("\\", "\\\\")
             # Escape any apostrophes for ffmpeg’s single-quoted syntax
             safe_path = safe_path.replace("'", "'\\''")
             f.write(f"file '{safe_path}'\n")
 
-def encode_mp3_to_m4a(mp3_file, out_file):
+def _append_adts(src, dst):
+    """
+    Copies one ADTS stream from src to dst, walking the frame headers of the
+    data as it passes through. Returns the stream's duration in seconds.
+    """
+    samples = 0
+    sample_rate = None
+    pending = b""  # start of a frame header that was split across two reads
+    skip = 0       # bytes of the current frame still to come in the next read
+    while True:
+        chunk = src.read(COPY_BUFFER_SIZE)
+        if not chunk:
+            break
+        dst.write(chunk)
+
+        buf = pending + chunk if pending else chunk
+        pos = skip
+        while pos + 7 <= len(buf):
+            # 12-bit syncword 0xFFF, layer 00
+            if buf[pos] != 0xFF or buf[pos + 1] & 0xF6 != 0xF0:
+                raise ValueError(f"Invalid ADTS frame header in {src.name} at offset {src.tell() - len(buf) + pos}")
+            sf_index = (buf[pos + 2] >> 2) & 0x0F
+            frame_length = ((buf[pos + 3] & 0x03) << 11) | (buf[pos + 4] << 3) | (buf[pos + 5] >> 5)
+            if sf_index >= len(ADTS_SAMPLE_RATES) or frame_length < 7:
+                raise ValueError(f"Invalid ADTS frame header in {src.name} at offset {src.tell() - len(buf) + pos}")
+            sample_rate = ADTS_SAMPLE_RATES[sf_index]
+            # Each raw data block holds 1024 samples
+            samples += 1024 * ((buf[pos + 6] & 0x03) + 1)
+            pos += frame_length
+
+        if pos >= len(buf):
+            pending, skip = b"", pos - len(buf)
+        else:
+            pending, skip = buf[pos:], 0
+
+    return samples / sample_rate if sample_rate else 0.0
+
+def concat_adts_files(aac_files, out_file):
+    """
+    Joins ADTS (.aac) files by appending their bytes into out_file.
+    ADTS frames are self-synchronizing, so no remux is needed.
+    The frames are counted during the copy, so this also returns each file's
+    exact duration in seconds (including encoder priming/padding), which is
+    what the chapter marks in the joined stream must follow.
     """
-    Convert a single MP3 file to AAC (.m4a) without altering 
+    durations = []
+    with open(out_file, 'wb') as dst:
+        for aac_file in aac_files:
+            with open(aac_file, 'rb') as src:
+                durations.append(_append_adts(src, dst))
+    return durations
+
+def encode_mp3_to_aac(mp3_file, out_file, threads=None):
+    """
+    Convert a single MP3 file to raw ADTS AAC (.aac) without altering 
     sample rate/channels if possible.
+    If threads is given, ffmpeg is limited to that many threads.
     """
     cmd = [
         "ffmpeg",
@@ -181,143 +310,286 @@ def encode_mp3_to_m4a(mp3_file, out_file):
         "-i", mp3_file,       # Input MP3
         "-vn",                # This drops any video/art track that might be embedded as H.264:
         "-c:a", "aac",
-        out_file
+        "-f", "adts"
     ]
-    subprocess.run(cmd, check=True)
+    if threads:
+        cmd += ["-threads", str(threads)]
+    cmd.append(out_file)
+    # No stdin (so ffmpeg can't grab the terminal from a worker thread), no
+    # stdout; stderr is collected and attached to the CalledProcessError.
+    subprocess.run(
+        cmd,
+        check=True,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        errors="replace"
+    )
 
-def parallel_encode_mp3s_to_m4a(input_folder, output_folder, max_workers=None):
+def parallel_encode_mp3s_to_aac(input_folder, output_folder, max_workers=None):
     """
     1) Finds all .mp3 in input_folder.
-    2) Encodes each in parallel to .m4a in output_folder.
-    3) Returns a list of output .m4a paths (sorted).
+    2) Encodes each in parallel to .aac (ADTS) in output_folder.
+    3) Returns a list of output .aac paths, in the same order as the MP3s
+       (files that failed to encode are left out).
+    max_workers is the number of cores this call may use (default: all of
+    them); they are split between the concurrent encodes and their threads.
     """
     if not os.path.exists(output_folder):
         os.makedirs(output_folder, exist_ok=True)
 
-    mp3_files = [
-        os.path.join(input_folder, f)
-        for f in os.listdir(input_folder)
-        if f.lower().endswith(".mp3")
-    ]
-    mp3_files.sort()
-
-    results = []
-    with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        futures = {}
-        for mp3 in mp3_files:
-            basename = os.path.splitext(os.path.basename(mp3))[0]
-            out_file = os.path.join(output_folder, basename + ".m4a")
-            fut = executor.submit(encode_mp3_to_m4a, mp3, out_file)
-            futures[fut] = out_file
+    mp3_files = find_mp3_files(input_folder)
+    if not mp3_files:
+        return []
+
+    # Each job only waits on an ffmpeg subprocess, so threads are enough;
+    # never start more workers than there are files to encode.
+    cpu_budget = max_workers or os.cpu_count() or 1
+    max_workers = min(cpu_budget, len(mp3_files))
+    # Split the core budget between the concurrent ffmpeg processes so they
+    # don't each start a full set of threads.
+    threads_per_job = max(1, cpu_budget // max_workers)
+
+    output_dir = Path(output_folder)
+    out_files = [str(output_dir / (Path(mp3).stem + ".aac")) for mp3 in mp3_files]
+
+    # Slot i holds the output of mp3_files[i] once it has been encoded
+    results = [None] * len(mp3_files)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(encode_mp3_to_aac, mp3, out_file, threads=threads_per_job): i
+            for i, (mp3, out_file) in enumerate(zip(mp3_files, out_files))
+        }
 
         # Gather results (this blocks until all are done)
         for fut in as_completed(futures):
-            out_file = futures[fut]
+            i = futures[fut]
             try:
                 fut.result()  # Will raise CalledProcessError if FFmpeg fails
-                results.append(out_file)
+                results[i] = out_files[i]
             except Exception as e:
-                print(f"Error encoding {out_file}: {e}")
+                print(f"Error encoding {out_files[i]}: {e}")
+                if getattr(e, "stderr", None):
+                    print(e.stderr.strip())
 
-    # Return sorted list of .m4a files
-    return sorted(results)
+    # Already in input order, no need to sort
+    return [out_file for out_file in results if out_file is not None]
 
-def convert_mp3_chapters_to_m4b(input_folder, output_file, book_metadata=None):
+def estimate_moov_size(probes, cover_path=None):
+    """
+    Estimates how many bytes the M4B's moov atom will need, so ffmpeg can
+    reserve that space at the start of the file (-moov_size) instead of
+    rewriting the whole file to move the moov there afterwards.
+    Most of it is the sample size table (4 bytes per audio frame of at
+    least 1024 samples); the chapter list and the cover art are stored
+    there too.
+    """
+    frames = sum(probe.duration * (probe.sample_rate or 48000) / 1024 for probe in probes)
+    size = frames * 4 + len(probes) * 512
+    if cover_path:
+        # The cover is re-encoded to MJPEG, so leave room for it to grow
+        size += 2 * os.path.getsize(cover_path)
+    return int(size * 1.25) + (64 << 10)
+
+def convert_mp3_chapters_to_m4b(input_folder, output_file, book_metadata=None, keep_intermediates=False,
+                                probes=None, max_workers=None, mp3_passthrough=False):
     """
     Main conversion flow:
-      1) Find MP3s
+      1) Find and probe MP3s (unless probes from probe_mp3s are passed in)
       2) Create ffmetadata with chapters + optional global metadata
-      3) Create concat list
-      4) Use ffmpeg to produce final M4B
+      3) Use a single ffmpeg run to read every chapter through the concat
+         demuxer, encode them with one AAC encoder and mux the final M4B
+
+    With keep_intermediates, the two-stage flow is used instead: each MP3 is
+    encoded to a raw ADTS .aac next to it, the .aac files are appended into
+    one stream, which is then wrapped into the M4B with a stream copy. The
+    per-chapter .aac files are left on disk afterwards. max_workers is the
+    number of cores that flow may use for encoding (see
+    parallel_encode_mp3s_to_aac).
+
+    With mp3_passthrough (and only MP3 chapters), nothing is re-encoded: the
+    MP3 frames from the concat demuxer are copied into the M4B. This takes
+    precedence over keep_intermediates.
+
+    book_metadata may also be a Future (e.g. a metadata lookup still running
+    in the background); it is only waited on once the chapters are encoded.
     """
-    m4a_files = parallel_encode_mp3s_to_m4a(input_folder, input_folder)
-
-    metadata_file = os.path.join(input_folder, "chapters.ffmetadata")
-    list_file = os.path.join(input_folder, "concat_list.txt")
-
-    create_ffmetadata(m4a_files, metadata_file, book_metadata=book_metadata)
-    create_concat_list(m4a_files, list_file)
-
-    # 1) Declare the first two inputs (concat list + ffmetadata)
-    ffmpeg_cmd = [
-        "ffmpeg",
-        "-hide_banner",
-        "-loglevel", "error",
-        "-f", "concat",
-        "-safe", "0",
-        "-i", list_file,
-        "-i", metadata_file
-    ]
-
-    # 2) If we have cover art, declare it as a third input
-    if book_metadata and 'cover' in book_metadata and book_metadata['cover'] and os.path.exists(book_metadata['cover']):
-        ffmpeg_cmd += ["-i", book_metadata['cover']]
-
-    # 3) Now specify the mapping for each input and output options
-    ffmpeg_cmd += [
-        "-map_metadata", "1",  # the second input (metadata file)
-        "-map", "0:a",         # the first input (audio from concat list)
-        "-c", "copy",
-        "-movflags", "faststart"
-    ]
-
-    # 4) If cover art is present, attach it
-    if book_metadata and 'cover' in book_metadata and book_metadata['cover'] and os.path.exists(book_metadata['cover']):
-        ffmpeg_cmd += [
-            "-map", "2",  # cover is the third input
-            "-c:v", "mjpeg",
-            "-metadata:s:v", 'title="Cover (front)"',
-            "-metadata:s:v", 'comment="Cover (front)"',
-            "-disposition:v:0", "attached_pic"
-        ]
+    concat_file = None
+    list_file = None
+    metadata_file = None
+    chapter_durations = None  # None: use the probed MP3 durations
+    if probes is None:
+        probes = probe_mp3s(find_mp3_files(input_folder))
+    mp3_files = [probe.path for probe in probes]
+
+    if mp3_passthrough and not all(probe.is_mp3 for probe in probes):
+        print("[WARN] Not every chapter is an MP3 stream; re-encoding to AAC instead of passing it through.")
+        mp3_passthrough = False
+
+    # Everything from here on may leave scratch files behind, which the
+    # finally block removes (also on an early return or exception)
+    try:
+        if keep_intermediates and not mp3_passthrough:
+            aac_files = parallel_encode_mp3s_to_aac(input_folder, input_folder, max_workers=max_workers)
+            if len(aac_files) != len(mp3_files):
+                print("Error converting MP3 chapters to M4B: not every chapter could be encoded.")
+                return
+            # Unique name next to the chapters (the joined stream is as large as
+            # the book, so it stays off the temp dir)
+            fd, concat_file = tempfile.mkstemp(dir=input_folder, suffix=".aac")
+            os.close(fd)
+            try:
+                chapter_durations = concat_adts_files(aac_files, concat_file)
+            except ValueError as e:
+                print(f"Error converting MP3 chapters to M4B: {e}")
+                return
+            # 1) Declare the audio input (all encoded chapters, back to back)
+            ffmpeg_cmd = [
+                "ffmpeg",
+                "-hide_banner",
+                "-loglevel", "error",
+                "-y",                  # Overwrite output (ffmpeg has no stdin to ask on)
+                "-f", "aac",
+                "-i", concat_file
+            ]
+            audio_args = [
+                "-map", "0:a",         # the first input (joined ADTS stream)
+                "-c:a", "copy",
+                "-bsf:a", "aac_adtstoasc"
+            ]
+        else:
+            with tempfile.NamedTemporaryFile(mode='w', suffix='_concat.txt', delete=False) as tmp:
+                list_file = tmp.name
+            create_concat_list(mp3_files, list_file)
+            # 1) Declare the audio input (concat list of the MP3s themselves)
+            ffmpeg_cmd = [
+                "ffmpeg",
+                "-hide_banner",
+                "-loglevel", "error",
+                "-y",                  # Overwrite output (ffmpeg has no stdin to ask on)
+                "-f", "concat",
+                "-safe", "0",
+                "-i", list_file
+            ]
+            audio_args = [
+                "-map", "0:a",         # the first input (audio from concat list)
+                # keep the MP3 frames as they are, or encode once to AAC
+                "-c:a", "copy" if mp3_passthrough else "aac"
+            ]
+        # The audio is always the first input; the metadata file comes next
+        metadata_index = 1
+
+        if isinstance(book_metadata, Future):
+            book_metadata = book_metadata.result()
+        # The ffmetadata file is small scratch, so it goes to the temp dir rather
+        # than the input folder (which may be a slow network share).
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.ffmetadata', delete=False) as tmp:
+            metadata_file = tmp.name
+        create_ffmetadata(probes, metadata_file, book_metadata=book_metadata, durations=chapter_durations)
+
+        # 2) Declare the ffmetadata input
+        ffmpeg_cmd += ["-i", metadata_file]
+
+        # 3) If we have cover art, declare it as the next input
+        has_cover = bool(book_metadata and 'cover' in book_metadata and book_metadata['cover'] and os.path.exists(book_metadata['cover']))
+        if has_cover:
+            ffmpeg_cmd += ["-i", book_metadata['cover']]
+
+        # 4) Now specify the mapping for each input and output options
+        ffmpeg_cmd += ["-map_metadata", str(metadata_index)]  # the metadata file
+        ffmpeg_cmd += audio_args
+
+        # 5) If cover art is present, attach it
+        if has_cover:
+            ffmpeg_cmd += [
+                "-map", str(metadata_index + 1),  # cover follows the metadata file
+                "-c:v", "mjpeg",
+                "-metadata:s:v", 'title="Cover (front)"',
+                "-metadata:s:v", 'comment="Cover (front)"',
+                "-disposition:v:0", "attached_pic"
+            ]
 
-    # 5) Finally, append the output filename
-    ffmpeg_cmd.append(output_file)
+        # 6) Reserve room for the moov atom at the front of the file, then
+        #    append the output filename
+        moov_size = estimate_moov_size(probes, book_metadata['cover'] if has_cover else None)
+        # The .m4b extension selects ffmpeg's ipod muxer, which only accepts
+        # AAC/ALAC/AC-3; MP3 audio needs the plain mp4 muxer.
+        if mp3_passthrough:
+            ffmpeg_cmd += ["-f", "mp4"]
 
-    try:
-        subprocess.run(ffmpeg_cmd, check=True)
-        print(f"Created audiobook: {output_file}")
-    except subprocess.CalledProcessError as e:
-        print(f"Error converting MP3 chapters to M4B: {e}")
+        try:
+            result = _run_ffmpeg(ffmpeg_cmd + ["-moov_size", str(moov_size), output_file])
+            if result.returncode != 0 and "reserved_moov_size is too small" in result.stderr:
+                # The estimate was short; let ffmpeg move the moov itself instead
+                if os.path.exists(output_file):
+                    os.remove(output_file)
+                result = _run_ffmpeg(ffmpeg_cmd + ["-movflags", "faststart", output_file])
+            if result.returncode != 0:
+                raise subprocess.CalledProcessError(result.returncode, result.args, stderr=result.stderr)
+            print(f"Created audiobook: {output_file}")
+        except subprocess.CalledProcessError as e:
+            print(f"Error converting MP3 chapters to M4B: {e}")
+            if e.stderr:
+                print(e.stderr.strip())
     finally:
         # Clean up
-        if os.path.exists(metadata_file):
+        if metadata_file and os.path.exists(metadata_file):
             os.remove(metadata_file)
-        if os.path.exists(list_file):
+        if concat_file and os.path.exists(concat_file):
+            os.remove(concat_file)
+        if list_file and os.path.exists(list_file):
             os.remove(list_file)
-        for m4a in m4a_files:
-            os.remove(m4a)
 
-def get_book_metadata(args, mp3_files):
+def _run_ffmpeg(cmd):
+    """
+    Runs an ffmpeg command without stdin, capturing its stderr.
+    ffmpeg can't prompt without stdin, so commands must pass -y (or never
+    hit an existing output).
+    """
+    return subprocess.run(
+        cmd,
+        stdin=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        errors="replace"
+    )
+
+def get_book_metadata(args, probes):
     """
     1) If user wants metadata from Google/OpenLibrary, fetch it.
     2) Otherwise, extract from first MP3 (ID3 tags) or fallback to defaults.
+    `probes` is the list returned by probe_mp3s for the book's MP3s.
     """
     # If title/author are not provided, try to read from the first file’s ID3
     if not args.title or not args.author:
-        id3_tags = extract_id3_tags(mp3_files[0])
-        default_title = id3_tags.get("album", "")
-        default_author = id3_tags.get("artist", "")
+        default_title = probes[0].album or ""
+        default_author = probes[0].artist or ""
     else:
         default_title = args.title
         default_author = args.author
 
-    # Decide metadata source
-    if args.metadata_source == "google":
-        # google books example
-        book_meta = fetch_metadata_google_books(
-            title=args.title or default_title,
-            author=args.author or default_author,
-            isbn=getattr(args, "isbn", None),
-            api_key=getattr(args, "api_key", None)
-        )
-    elif args.metadata_source == "openlibrary":
-        book_meta = fetch_metadata_openlibrary(
-            title=args.title or default_title,
-            author=args.author or default_author,
-            input_folder=os.path.dirname(mp3_files[0])  # store cover near first MP3
-        )
-    else:
+    # Decide metadata source. A failed lookup (network error, error page
+    # instead of JSON, ...) falls back to the ID3 metadata below.
+    try:
+        if args.metadata_source == "google":
+            # google books example
+            book_meta = fetch_metadata_google_books(
+                title=args.title or default_title,
+                author=args.author or default_author,
+                isbn=getattr(args, "isbn", None),
+                api_key=getattr(args, "api_key", None)
+            )
+        elif args.metadata_source == "openlibrary":
+            book_meta = fetch_metadata_openlibrary(
+                title=args.title or default_title,
+                author=args.author or default_author,
+                input_folder=os.path.dirname(probes[0].path)  # store cover near first MP3
+            )
+        else:
+            book_meta = None
+    except (requests.RequestException, ValueError) as e:
+        print(f"[WARN] Metadata lookup failed, using ID3 tags instead: {e}")
         book_meta = None
 
     if book_meta:
@@ -325,7 +597,7 @@ def get_book_metadata(args, mp3_files):
         print(book_meta)
     else:
         # fallback: embedded cover from first MP3
-        cover_art = extract_embedded_cover_art(mp3_files[0])
+        cover_art = extract_embedded_cover_art(probes[0])
         book_meta = {
             "title": args.title or default_title,
             "authors": [args.author or default_author],
@@ -334,10 +606,51 @@ def get_book_metadata(args, mp3_files):
         }
     return book_meta
 
+@functools.lru_cache(maxsize=None)
+def _http_session():
+    """
+    Returns the shared HTTP session. Connections are pooled and kept alive
+    across the metadata lookups and cover downloads of every book, and
+    failed requests are retried with backoff. With requests-cache installed,
+    responses are persisted in HTTP_CACHE_FILE so reruns don't hit the
+    network again.
+    """
+    if requests_cache is None:
+        session = requests.Session()
+    else:
+        os.makedirs(os.path.dirname(HTTP_CACHE_FILE), exist_ok=True)
+        session = requests_cache.CachedSession(
+            os.path.splitext(HTTP_CACHE_FILE)[0],
+            backend="sqlite",
+            expire_after=HTTP_CACHE_EXPIRE_AFTER
+        )
+    adapter = HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(total=3, backoff_factor=0.3)
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def download_file(url, out_path):
+    """Streams url to out_path in chunks instead of buffering it in memory."""
+    with _http_session().get(url, allow_redirects=True, stream=True, timeout=HTTP_TIMEOUT) as resp:
+        resp.raise_for_status()
+        with open(out_path, 'wb') as f:
+            for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+
 def fetch_metadata_google_books(title=None, author=None, isbn=None, api_key=None):
     """
     Very basic example. You’ll want to refine the search logic.
+    Lookups are cached per (title, author, isbn), case-insensitively.
     """
+    metadata = _lookup_google_books((title or "").lower(), (author or "").lower(), isbn, api_key)
+    return dict(metadata) if metadata else None
+
+@functools.lru_cache(maxsize=None)
+def _lookup_google_books(title, author, isbn, api_key):
     print("[INFO] Fetching metadata from Google Books API...")
     # Build a query string
     query_parts = []
@@ -356,7 +669,8 @@ def fetch_metadata_google_books(title=None, author=None, isbn=None, api_key=None
     if api_key:
         params["key"] = api_key
 
-    resp = requests.get("https://www.googleapis.com/books/v1/volumes", params=params)
+    resp = _http_session().get("https://www.googleapis.com/books/v1/volumes", params=params,
+                               timeout=HTTP_TIMEOUT)
     data = resp.json()
 
     items = data.get("items", [])
@@ -379,37 +693,81 @@ def fetch_metadata_openlibrary(title=None, author=None, input_folder=None):
     Example stub using openlibrary-client (Requires pip install openlibrary-client).
     You’ll need to adapt this to your actual usage pattern:
       e.g., searching by ISBN, or calling the .get() method, etc.
+    Lookups are cached per (title, author), case-insensitively; the cover is
+    saved into input_folder unless it is already there.
     """
     if not OpenLibrary:
         print("[WARN] openlibrary-client not installed. Skipping.")
         return None
 
+    work_info = _lookup_openlibrary((title or "").lower(), (author or "").lower())
+    if not work_info:
+        return None
+
+    # Covers are downloaded (with redirect following) using this format:
+    # https://covers.openlibrary.org/b/id/{cover_id}-L.jpg
+    cover_id = work_info["cover_id"]
+    cover_path = None
+    if cover_id:
+        cover_path = f"{input_folder}/{cover_id}-cover.jpg"
+        if not os.path.exists(cover_path):
+            try:
+                download_file(f"https://covers.openlibrary.org/b/id/{cover_id}-L.jpg", cover_path)
+                print(f"[INFO] Saved cover image to {cover_path}")
+            except requests.RequestException as e:
+                print(f"[WARN] Could not download cover image: {e}")
+                if os.path.exists(cover_path):
+                    os.remove(cover_path)
+                cover_path = None
+    return {
+        "title": work_info["title"],
+        "authors": list(work_info["authors"]),
+        "publisher": work_info["publisher"],
+        "cover": cover_path,
+    }
+
+@functools.lru_cache(maxsize=None)
+def _lookup_openlibrary(title, author):
     print("[INFO] Fetching metadata from Open Library...")
     ol = OpenLibrary()
+    ol.session = _http_session()
     work_result = ol.Work.search(title=title, author=author)
     if not work_result:
         print("[WARN] No results from Open Library.")
         return None
     work = ol.Work.get(work_result.identifiers['olid'][0])
 
-    # Covers are downloaded (with redirect following) using this format:
-    # https://covers.openlibrary.org/b/id/{cover_id}-L.jpg
-    cover_id = work.covers[0] if len(work.covers) > 0 else None
-    cover_url = f"https://covers.openlibrary.org/b/id/{cover_id}-L.jpg" if cover_id else None
-    # Fetch the cover image
-    if cover_url:
-        cover_resp = requests.get(cover_url, allow_redirects=True)
-        cover_path = f"{input_folder}/{cover_id}-cover.jpg"
-        with open(cover_path, 'wb') as f:
-            f.write(cover_resp.content)
-        print(f"[INFO] Saved cover image to {cover_path}")
     return {
         "title": work_result.title,
-        "authors": [auth['name'] for auth in work_result.authors],
+        "authors": tuple(auth['name'] for auth in work_result.authors),
         "publisher": getattr(work_result, 'publisher', '') or '',
-        "cover": cover_path if cover_url else None,
+        "cover_id": work.covers[0] if len(work.covers) > 0 else None,
     }
 
+def process_subfolder(args, subdir, max_workers=None):
+    """Converts one subfolder of MP3s into its own M4B ('multiple' mode)."""
+    mp3_files = find_mp3_files(subdir)
+
+    if not mp3_files:
+        print(f"[WARN] No MP3 files in subfolder: {subdir}. Skipping.")
+        return
+
+    print(f"[INFO] Converting subfolder: {subdir}")
+
+    # Read tags/durations once, then fetch metadata while the chapters encode
+    probes = probe_mp3s(mp3_files)
+
+    # Construct output filename for each subfolder
+    folder_name = Path(subdir).name
+    output_m4b = os.path.join(args.output_folder, folder_name + ".m4b")
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        book_meta = executor.submit(get_book_metadata, args, probes)
+        convert_mp3_chapters_to_m4b(subdir, output_m4b, book_metadata=book_meta,
+                                    keep_intermediates=args.keep_intermediates, probes=probes,
+                                    max_workers=max_workers, mp3_passthrough=args.mp3_passthrough)
+    print(f"[INFO] Finished subfolder -> {output_m4b}")
+
 def main():
     parser = argparse.ArgumentParser(
         description="Convert MP3 chapters to M4B with optional metadata fetching."
@@ -429,68 +787,58 @@ def main():
     parser.add_argument("--title", help="Book title (for metadata lookup).")
     parser.add_argument("--author", help="Book author (for metadata lookup).")
     parser.add_argument("--output-folder", help="Where to place M4B files in nested mode")
+    parser.add_argument("--keep-intermediates", action="store_true",
+                        help="Encode each MP3 to an intermediate .aac first and keep those files, "
+                             "instead of converting everything in a single ffmpeg pass.")
+    parser.add_argument("--mp3-passthrough", action="store_true",
+                        help="Copy the MP3 audio into the M4B as-is instead of re-encoding it to AAC "
+                             "(much faster, but not every player supports MP3 audio in M4B).")
+    parser.add_argument("--book-parallelism", type=int, default=2,
+                        help="How many books to convert at once in 'multiple' mode (default: 2).")
 
     args = parser.parse_args()
 
     # ============== SINGLE MODE ==============
     if args.mode == "single":
-        mp3_files = [
-            os.path.join(args.input_folder, f)
-            for f in os.listdir(args.input_folder)
-            if f.lower().endswith(".mp3")
-        ]
-        mp3_files.sort()
+        mp3_files = find_mp3_files(args.input_folder)
 
         if not mp3_files:
             print("[ERROR] No MP3 files found in input folder.")
             sys.exit(1)
 
-        # Build metadata
-        book_meta = get_book_metadata(args, mp3_files)
+        # Read tags/durations once, then fetch metadata while the chapters encode
+        probes = probe_mp3s(mp3_files)
 
         # If output-file not specified, pick a default
         if not args.output_file:
             # e.g. the folder name + ".m4b"
-            folder_name = os.path.basename(args.input_folder.rstrip(os.sep))
+            folder_name = Path(args.input_folder).resolve().name
             args.output_file = folder_name + ".m4b"
 
-        convert_mp3_chapters_to_m4b(args.input_folder, args.output_file, book_metadata=book_meta)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            book_meta = executor.submit(get_book_metadata, args, probes)
+            convert_mp3_chapters_to_m4b(args.input_folder, args.output_file, book_metadata=book_meta,
+                                        keep_intermediates=args.keep_intermediates, probes=probes,
+                                        mp3_passthrough=args.mp3_passthrough)
 
     # ============== MULTIPLE MODE ==============
     else:
-        subfolders = [
-            os.path.join(args.input_folder, d)
-            for d in os.listdir(args.input_folder)
-            if os.path.isdir(os.path.join(args.input_folder, d))
-        ]
+        subfolders = find_subfolders(args.input_folder)
 
         if not subfolders:
             print("[ERROR] No subfolders found in input folder for 'multiple' mode.")
             sys.exit(1)
 
-        for subdir in subfolders:
-            mp3_files = [
-                os.path.join(subdir, f)
-                for f in os.listdir(subdir)
-                if f.lower().endswith(".mp3")
-            ]
-            mp3_files.sort()
-
-            if not mp3_files:
-                print(f"[WARN] No MP3 files in subfolder: {subdir}. Skipping.")
-                continue
-
-            print(f"[INFO] Converting subfolder: {subdir}")
-
-            # Build metadata
-            book_meta = get_book_metadata(args, mp3_files)
-
-            # Construct output filename for each subfolder
-            folder_name = os.path.basename(subdir.rstrip(os.sep))
-            output_m4b = os.path.join(args.output_folder, folder_name + ".m4b")
+        # Books are independent, so convert several at once. Split the cores
+        # between them so books x chapter encoders stays within cpu_count().
+        cpu_count = os.cpu_count() or 1
+        book_parallelism = max(1, min(args.book_parallelism, len(subfolders), cpu_count))
+        workers_per_book = max(1, cpu_count // book_parallelism)
 
-            convert_mp3_chapters_to_m4b(subdir, output_m4b, book_metadata=book_meta)
-            print(f"[INFO] Finished subfolder -> {output_m4b}")
+        with ThreadPoolExecutor(max_workers=book_parallelism) as executor:
+            convert_book = functools.partial(process_subfolder, args, max_workers=workers_per_book)
+            # list() so an exception in any book is raised here
+            list(executor.map(convert_book, subfolders))
 
 if __name__ == "__main__":
     main()